@@ -1,8 +1,11 @@
 import asyncio
+import importlib.util
 import sys
+import threading
 from typing import Optional
 from contextlib import AsyncExitStack
  
+import httpx
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
  
@@ -10,25 +13,78 @@ from dotenv import load_dotenv
 from openai import AsyncOpenAI, OpenAI
 import json
  
+try:
+    import orjson  # 可选依赖，解析更快；orjson.JSONDecodeError 是 json.JSONDecodeError 的子类
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+ 
 load_dotenv()  # load environment variables from .env
  
+# 持久化的 HTTP 连接池：保持与 DeepSeek 的长连接，避免每次请求重新握手
+# HTTP/2 需要可选依赖 h2，未安装时退回 HTTP/1.1 keep-alive
+_http_client = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60),
+)
+ 
  
 def format_tools_for_llm(tool) -> str:
     """对tool进行格式化
     Returns:
         格式化之后的tool描述
     """
-    args_desc = []
-    if "properties" in tool.inputSchema:
-        for param_name, param_info in tool.inputSchema["properties"].items():
-            arg_desc = (
-                f"- {param_name}: {param_info.get('description', 'No description')}"
-            )
-            if param_name in tool.inputSchema.get("required", []):
+    parts = []
+    _format_tool_into(parts, tool)
+    return "\n".join(parts)
+ 
+ 
+def _format_tool_into(parts: list[str], tool) -> None:
+    """将单个tool的描述逐行写入 parts，由调用方统一 join"""
+    schema = tool.inputSchema
+    parts.append("Tool: " + tool.name)
+    parts.append("Description: " + str(tool.description))
+    parts.append("Arguments:")
+    n = len(parts)
+    if "properties" in schema:
+        required = schema.get("required", ())
+        for param_name, param_info in schema["properties"].items():
+            arg_desc = "- " + param_name + ": " + str(param_info.get("description", "No description"))
+            if param_name in required:
                 arg_desc += " (required)"
-            args_desc.append(arg_desc)
+            parts.append(arg_desc)
+    if len(parts) == n:
+        # 没有参数时保留 "Arguments:" 之后的空行，与原格式一致
+        parts.append("")
  
-    return f"Tool: {tool.name}\nDescription: {tool.description}\nArguments:\n{chr(10).join(args_desc)}"
+ 
+async def _ainput(prompt: str) -> str:
+    """在守护线程中读取一行输入，不阻塞事件循环
+ 
+    不使用 asyncio.to_thread：其线程池会在退出时被等待，
+    Ctrl-C 后进程会一直卡在尚未返回的 input() 上。守护线程不会阻止进程退出。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+ 
+    def deliver(method, value):
+        if not future.done():
+            method(value)
+ 
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            callback = (deliver, future.set_exception, e)
+        else:
+            callback = (deliver, future.set_result, line)
+        try:
+            loop.call_soon_threadsafe(*callback)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+ 
+    threading.Thread(target=read, daemon=True).start()
+    return await future
  
  
 class MCPClient:
@@ -38,9 +94,11 @@ class MCPClient:
         self.client = AsyncOpenAI(
             base_url="https://api.deepseek.com",
             api_key="****************************",
+            http_client=_http_client,
         )
         self.model = "deepseek-chat"
         self.messages = []
+        self.tool_names = set()
  
     async def connect_to_server(self, server_script_path: str):
         """连接MCP服务器"""
@@ -58,8 +116,13 @@ class MCPClient:
         response = await self.session.list_tools()
         tools = response.tools
         print("\n服务器中可用的工具：", [tool.name for tool in tools])
+        # 缓存工具名，execute_tool 不必每次重新 list_tools
+        self.tool_names = {tool.name for tool in tools}
  
-        tools_description = "\n".join([format_tools_for_llm(tool) for tool in tools])
+        parts = []
+        for tool in tools:
+            _format_tool_into(parts, tool)
+        tools_description = "\n".join(parts)
         # 修改系统提示
         system_prompt = ("You are a helpful assistant with access to these tools:\n\n"
             f"{tools_description}\n"
@@ -968,16 +1031,23 @@ class MCPClient:
         self.messages.append({"role": "system", "content": system_prompt})
  
     async def chat(self, prompt, role="user"):
-        """与LLM进行交互"""
+        """与LLM进行交互，边接收边打印回复，返回完整内容"""
         self.messages.append({"role": role, "content": prompt})
  
         # 初始化 LLM API 调用
-        response = await self.client.chat.completions.create(
+        stream = await self.client.chat.completions.create(
             model=self.model,
             messages=self.messages,
+            stream=True,
         )
-        llm_response = response.choices[0].message.content
-        return llm_response
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                text = chunk.choices[0].delta.content
+                parts.append(text)
+                print(text, end="", flush=True)
+        print()
+        return "".join(parts)
  
     async def execute_tool(self, llm_response: str):
         """Process the LLM response and execute tools if needed.
@@ -986,16 +1056,11 @@ class MCPClient:
         Returns:
             The result of tool execution or the original response.
         """
-        import json
- 
         try:
-            tool_call = json.loads(llm_response.replace("```json\n", "").replace("```", ""))
+            tool_call = _json_loads(llm_response.replace("```json\n", "").replace("```", ""))
             if "tool" in tool_call and "arguments" in tool_call:
                 # result = await self.session.call_tool(tool_name, tool_args)
-                response = await self.session.list_tools()
-                tools = response.tools
- 
-                if any(tool.name == tool_call["tool"] for tool in tools):
+                if tool_call["tool"] in self.tool_names:
                     try:
                         print("[提示]：正在执行函数")
                         result = await self.session.call_tool(
@@ -1020,18 +1085,21 @@ class MCPClient:
             return llm_response
  
  
+    async def cleanup(self):
+        """关闭 MCP 会话及 stdio 连接"""
+        await self.exit_stack.aclose()
+ 
     async def chat_loop(self):
         """运行交互式聊天循环"""
         print("MCP 客户端启动")
         print("输入 /bye 退出")
  
         while True:
-            prompt = input(">>> ").strip()
+            prompt = (await _ainput(">>> ")).strip()
             if prompt.lower() == '/bye':
                 break
  
             llm_response = await self.chat(prompt)
-            print(llm_response)
  
             result = await self.execute_tool(llm_response)
  
@@ -1039,7 +1107,6 @@ class MCPClient:
                 self.messages.append({"role": "assistant", "content": llm_response})
  
                 final_response = await self.chat(result, "system")
-                print(final_response)
                 self.messages.append(
                     {"role": "assistant", "content": final_response}
                 )
@@ -1054,8 +1121,12 @@ async def main():
  
     client = MCPClient()
  
-    await client.connect_to_server(sys.argv[1])
-    await client.chat_loop()
+    try:
+        await client.connect_to_server(sys.argv[1])
+        await client.chat_loop()
+    finally:
+        await client.cleanup()
+        await _http_client.aclose()
  
  
 if __name__ == "__main__":
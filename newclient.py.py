@@ -1,16 +1,38 @@
 import asyncio
+import hashlib
+import importlib.util
+import random
+import re
 import sys
+import threading
+import uuid
 from typing import Optional
 from contextlib import AsyncExitStack
 
+import httpx
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.types import CallToolResult, ServerNotification, TextContent, ToolListChangedNotification
 
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAI
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+from openai.types.chat import ChatCompletionToolParam
+from pydantic import TypeAdapter
 import json
 
-load_dotenv()  # load environment variables from .env
+try:
+    import orjson  # 可选依赖，解析 tool 参数更快
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 所有 MCPClient 共享的 HTTP 连接池：保持与 DeepSeek 的长连接，避免每次请求重新握手
+# HTTP/2 需要可选依赖 h2，未安装时退回 HTTP/1.1 keep-alive
+_http_client = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
 
 
 def format_tools_for_llm(tool) -> str:
@@ -31,46 +53,70 @@ def format_tools_for_llm(tool) -> str:
     return f"Tool: {tool.name}\nDescription: {tool.description}\nArguments:\n{chr(10).join(args_desc)}"
 
 
-class MCPClient:
-    def __init__(self):
-        self.session: Optional[ClientSession] = None
-        self.exit_stack = AsyncExitStack()
-        self.client = AsyncOpenAI(
-            base_url="https://api.deepseek.com/v1",
-            api_key="****************************",
-        )
-        self.model = "deepseek-chat"
-        self.messages = []
-        self.tools = []
+def _mk_tool(name: str, description: str | None, schema: dict) -> ChatCompletionToolParam:
+    """构造 OpenAI 格式的 tool 定义，参数 schema 放在 "parameters" 字段"""
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description or "",
+            "parameters": schema,
+        },
+    }
 
-    async def connect_to_server(self, server_script_path: str):
-        """连接MCP服务器"""
-        server_params = StdioServerParameters(
-            command="python",
-            args=[server_script_path],
-            env=None
-        )
 
-        self.stdio, self.write = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-        await self.session.initialize()
+# 连接时校验一次 tool 定义，尽早发现格式错误
+_TOOLS_ADAPTER = TypeAdapter(list[ChatCompletionToolParam])
 
-        # 列出可用工具
-        response = await self.session.list_tools()
-        tools = response.tools
-        print("\n服务器中可用的工具：", [tool.name for tool in tools])
-
-        self.tools = [{
-            "type": 'function',
-            "function": {
-                "name": tool.name,
-                "description": tool.description,
-                "input_schema": tool.inputSchema
-            }
-        } for tool in tools]
-        tools_description = "\n".join([format_tools_for_llm(tool) for tool in tools])
-        # 修改系统prompt
-        system_prompt = (
+
+# 同时进行中的 LLM 请求 / 工具调用数量上限
+MAX_CONCURRENCY = 32
+# 触发限流 (429)、连接失败或服务端 5xx 时的最大尝试次数
+LLM_MAX_RETRIES = 5
+_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# 写入消息历史的单个工具结果最大字符数，超出部分截断并附上内容哈希
+TOOL_RESULT_MAX_CHARS = 8000
+# 结果本身就是模型要返回的完整脚本，不能截断
+UNTRUNCATED_TOOLS = frozenset({"finalize_script"})
+
+# chat_batch 单次 LLM 调用合并的最大请求数
+BATCH_MAX_SIZE = 8
+
+BATCH_INSTRUCTION = (
+    "下面有 {n} 个相互独立的请求，请逐个处理。"
+    "每个结果以单独一行 \"=== RESPONSE i ===\" 开头（i 为对应请求编号），不要输出其他内容。"
+)
+_BATCH_RESPONSE_RE = re.compile(r"^=== RESPONSE (\d+) ===[ \t]*$", re.MULTILINE)
+
+# 历史消息（不含 messages[0]）总字符数超过该阈值时压缩为摘要，只保留最近一轮
+HISTORY_CHAR_LIMIT = 24000
+# 滑动窗口：压缩后保留的最近对话轮数
+HISTORY_KEEP_TURNS = 6
+# 轮数超过该值才压缩一次，两次压缩之间历史只追加、前缀缓存保持有效
+HISTORY_MAX_TURNS = 12
+# 消息总条数上限（含系统prompt），超过时与字符数超限一样只保留最近一轮
+HISTORY_MAX_MESSAGES = 64
+
+SUMMARY_PROMPT = "请将以下对话历史压缩为简洁的摘要，保留用户需求、已生成的脚本要点和工具调用结果，不要添加新内容。"
+
+
+def _extract_text(result: CallToolResult, truncate: bool = True) -> str:
+    """拼接工具结果中的所有文本块；truncate 为真且过长时只保留前 TOOL_RESULT_MAX_CHARS 个字符"""
+    text = "".join(part.text for part in result.content if part.type == "text")
+    if truncate and len(text) > TOOL_RESULT_MAX_CHARS:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        text = f"{text[:TOOL_RESULT_MAX_CHARS]}\n...[已截断，共 {len(text)} 字符，sha256:{digest}]"
+    return text
+
+
+async def _invalid_arguments(arguments: str, error: Exception):
+    """tool 参数不是合法 JSON：抛出的异常由 gather 收集，转成该调用的错误消息"""
+    raise ValueError(f"invalid arguments {arguments!r}: {error}")
+
+
+# AFSIM 脚本编写规则
+AFSIM_INSTRUCTIONS = (
             """你是一个专业的AFSIM脚本编写与前端编程助手，严格遵守以下指令：
                         【核心原则】
                         1. 生成内容必须与样板脚本格式100%一致，包括所有字段、缩进、注释和关键字
@@ -118,7 +164,12 @@ class MCPClient:
                         ▶ 仅返回可执行的完整脚本
                         ▶ 禁止任何解释性文字/注释，如```等符号
                         ▶ 保留样板所有注释和空行格式
-            【样板脚本】           
+"""
+)
+
+# AFSIM 样板脚本
+AFSIM_SAMPLE_SCRIPT = (
+"""            【样板脚本】           
 ## 物理特征定义
 + 如红外信号特征、光学特征、雷达特征。
 + 在所有代码块的外面定义，在platform或platform_type中引用。
@@ -988,53 +1039,345 @@ end_platform
 ## 
             【/样板脚本】
         """
+)
+
+# 系统prompt（模块级常量，所有连接共享）。规则与样板均为静态内容，
+# 始终作为 messages[0] 发送且从不修改，DeepSeek 可对这段前缀复用 KV 缓存
+SYSTEM_PROMPT = AFSIM_INSTRUCTIONS + AFSIM_SAMPLE_SCRIPT
+
+
+async def _ainput(prompt: str) -> str:
+    """在守护线程中读取一行输入，不阻塞事件循环
+
+    不使用 asyncio.to_thread：其线程池会在退出时被等待，
+    Ctrl-C 后进程会一直卡在尚未返回的 input() 上。守护线程不会阻止进程退出。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(method, value):
+        if not future.done():
+            method(value)
+
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            callback = (deliver, future.set_exception, e)
+        else:
+            callback = (deliver, future.set_result, line)
+        try:
+            loop.call_soon_threadsafe(*callback)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+class MCPClient:
+    _dotenv_loaded = False
+
+    def __init__(self):
+        if not MCPClient._dotenv_loaded:
+            load_dotenv()  # load environment variables from .env
+            MCPClient._dotenv_loaded = True
+        self.session: Optional[ClientSession] = None
+        self.exit_stack = AsyncExitStack()
+        self.client = AsyncOpenAI(
+            base_url="https://api.deepseek.com/v1",
+            api_key="****************************",
+            http_client=_http_client,
+            # 重试统一由 _request_completion 负责，避免与 SDK 内置重试叠加
+            max_retries=0,
         )
+        self.model = "deepseek-chat"
+        self.messages = []
+        self.tools = []
+        self._tool_dispatch = {}
+        self._tools_stale = False
+        # 同一会话的请求使用同一个缓存键，便于服务端把它们路由到同一份前缀缓存
+        self.session_id = uuid.uuid4().hex
+        self._sem = asyncio.Semaphore(MAX_CONCURRENCY)
 
-        self.messages.append({"role": "system", "content": system_prompt})
+    async def connect_to_server(self, server_script_path: str):
+        """连接MCP服务器"""
+        server_params = StdioServerParameters(
+            command="python",
+            args=[server_script_path],
+            env=None
+        )
+
+        self.stdio, self.write = await self.exit_stack.enter_async_context(stdio_client(server_params))
+        self.session = await self.exit_stack.enter_async_context(
+            ClientSession(self.stdio, self.write, message_handler=self._handle_message)
+        )
+        await self.session.initialize()
+
+        # 列出可用工具
+        await self._load_tools()
+        print("\n服务器中可用的工具：", list(self._tool_dispatch))
+
+        # 系统prompt 使用模块级常量，不再每次连接时重新构造
+        # messages[0] 只写入一次且不再修改，保证 DeepSeek 的前缀缓存能够命中
+        if not self.messages:
+            self.messages.append({"role": "system", "content": SYSTEM_PROMPT})
+
+    async def _load_tools(self):
+        """拉取工具列表并构建 OpenAI tools 定义，结果在各轮 chat() 间复用"""
+        response = await self.session.list_tools()
+        tools = response.tools
+
+        # tool 名称 -> tool 定义，调用时 O(1) 查找
+        self._tool_dispatch = {tool.name: tool for tool in tools}
+        self.tools = _TOOLS_ADAPTER.validate_python(
+            [_mk_tool(tool.name, tool.description, tool.inputSchema) for tool in tools]
+        )
+        self._tools_stale = False
+
+    async def _handle_message(self, message):
+        """处理服务器推送的消息：工具列表变化时标记缓存失效
+
+        该回调运行在会话的接收循环中，不能在这里直接 await list_tools()，
+        由下一次 chat() 重新拉取。
+        """
+        if isinstance(message, ServerNotification) and isinstance(message.root, ToolListChangedNotification):
+            self._tools_stale = True
+
+    async def _consume_stream(self, stream, content_parts: list[str], tool_calls: dict):
+        """消费流式响应，逐段产出文本，并把 tool_calls 的增量片段按 index 聚合"""
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content_parts.append(delta.content)
+                yield delta.content
+            for tc in delta.tool_calls or ():
+                entry = tool_calls.setdefault(tc.index, {"id": None, "name": "", "arguments": []})
+                if tc.id:
+                    entry["id"] = tc.id
+                if tc.function is not None:
+                    if tc.function.name:
+                        entry["name"] += tc.function.name
+                    if tc.function.arguments:
+                        entry["arguments"].append(tc.function.arguments)
+
+    async def _request_completion(self, **kwargs):
+        """调用 chat.completions.create，限流或临时故障时指数退避重试（调用方持有并发名额）"""
+        for attempt in range(LLM_MAX_RETRIES):
+            try:
+                return await self.client.chat.completions.create(
+                    **kwargs, extra_body={"prompt_cache_key": self.session_id}
+                )
+            except _RETRYABLE_ERRORS:
+                if attempt == LLM_MAX_RETRIES - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt * 0.5 + random.random() * 0.1)
+
+    async def _create_completion(self, **kwargs):
+        """非流式请求，受 MAX_CONCURRENCY 限制"""
+        async with self._sem:
+            return await self._request_completion(**kwargs)
+
+    async def _stream_completion(self, **kwargs):
+        """流式请求，逐个产出 chunk；整个流消费完之前一直占用并发名额"""
+        async with self._sem:
+            stream = await self._request_completion(**kwargs, stream=True)
+            async for chunk in stream:
+                yield chunk
+
+    async def _call_tool(self, tool_name: str, tool_args: dict):
+        """调用 MCP 工具，与 LLM 请求共用并发上限"""
+        if tool_name not in self._tool_dispatch:
+            return CallToolResult(
+                content=[TextContent(type="text", text=f"No server found with tool: {tool_name}")],
+                isError=True,
+            )
+        async with self._sem:
+            return await self.session.call_tool(tool_name, tool_args)
+
+    async def _compact_history(self):
+        """历史过长时，将较早的对话压缩为一条摘要消息
+
+        压缩后的结构为 [系统prompt, 摘要, *最近 HISTORY_KEEP_TURNS 轮]；
+        超过字符数或条数上限时只保留最近一轮，最近一轮本身超限时也并入摘要。
+        messages[0]（主系统prompt）保持不变，前缀缓存依然可以命中。
+        """
+        # 每一轮从 user 消息开始；按轮切分可避免把 tool_calls 与对应的 tool 结果拆开
+        turn_starts = [i for i, m in enumerate(self.messages) if i > 0 and m["role"] == "user"]
+        too_long = (
+            len(self.messages) > HISTORY_MAX_MESSAGES
+            or sum(len(m.get("content") or "") for m in self.messages[1:]) > HISTORY_CHAR_LIMIT
+        )
+        if not too_long and len(turn_starts) <= HISTORY_MAX_TURNS:
+            return
+        keep = 1 if too_long else HISTORY_KEEP_TURNS
+        if len(turn_starts) > keep:
+            cut = turn_starts[-keep]
+        elif too_long:
+            # 仅最近一轮就已超限：该轮已经结束（最终回复已追加），可整体并入摘要
+            cut = len(self.messages)
+        else:
+            return
+        if cut <= 2:
+            return
+
+        dialogue = "\n".join(f"{m['role']}: {m.get('content') or ''}" for m in self.messages[1:cut])
+        response = await self._create_completion(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": dialogue},
+            ],
+        )
+        summary = response.choices[0].message.content
+        self.messages[1:cut] = [{"role": "system", "content": f"此前对话摘要：\n{summary}"}]
 
     async def chat(self, prompt, role="user"):
-        """与LLM进行交互"""
+        """与LLM进行交互，以流式方式逐段产出模型回复
+
+        self.messages 只追加、不重排也不原地修改（压缩历史除外），
+        保证相邻两次请求的前缀逐字节一致。
+        """
         self.messages.append({"role": role, "content": prompt})
+        if self._tools_stale:
+            await self._load_tools()
 
-        # TODO 第一次发送将tools发送给模型
-        # 初始化 LLM API 调用
-        response = await self.client.chat.completions.create(
+        # 第一次发送将tools发送给模型
+        stream = self._stream_completion(
             model=self.model,
             messages=self.messages,
             tools=self.tools,
             tool_choice="auto",
-            max_completion_tokens=8072
+            max_completion_tokens=8072,
         )
-        content = response.choices[0]
-        # TODO 若 content.finish_reason == "tool_calls" 则调用了 MCP tools方法
-        # TODO 发送第二次请求 将模型执行tools方法后的文本返回
-        if content.finish_reason == "tool_calls":
-            # 如果需要使用工具，解析工具调用
-            tool_call = content.message.tool_calls[0]
-            tool_name = tool_call.function.name  # tools方法名
-            tool_args = json.loads(tool_call.function.arguments)  # tools方法需要的参数
+        content_parts = []
+        tool_calls = {}
+        async for text in self._consume_stream(stream, content_parts, tool_calls):
+            yield text
+
+        # 若本次回复没有调用tool方法，直接记录结果
+        if not tool_calls:
+            self.messages.append({"role": "assistant", "content": "".join(content_parts)})
+            await self._compact_history()
+            return
+
+        # 调用了 MCP tools方法：还原完整的 assistant 消息
+        calls = [tool_calls[i] for i in sorted(tool_calls)]
+        self.messages.append({
+            "role": "assistant",
+            "content": "".join(content_parts) or None,
+            "tool_calls": [{
+                "id": call["id"],
+                "type": "function",
+                "function": {"name": call["name"], "arguments": "".join(call["arguments"])},
+            } for call in calls],
+        })
+
+        coros = []
+        call_tool = self._call_tool
+        for call in calls:
+            tool_name = call["name"]  # tools方法名
+            arguments = "".join(call["arguments"])
+            try:
+                # tools方法需要的参数；无参调用的 arguments 可能是空字符串
+                tool_args = _json_loads(arguments) if arguments else {}
+            except ValueError as e:
+                # 参数无法解析时不执行该工具，错误信息作为它的结果返回给模型
+                coros.append(_invalid_arguments(arguments, e))
+                continue
             print(f"本次调用了{tool_name} 方法，方法参数包括：{tool_args}")
-
-            # 执行工具方法
-            result = await self.session.call_tool(tool_name, tool_args)
-            # 将结果存入消息历史
-            self.messages.append(content.message.model_dump())
+            coros.append(call_tool(tool_name, tool_args))
+
+        # 并发执行所有工具方法，结果顺序与 tool_calls 一致；
+        # 单个工具出错不影响其他调用，错误信息作为该调用的结果返回给模型
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        # 将结果按 tool_call_id 存入消息历史
+        for call, result in zip(calls, results):
+            if isinstance(result, Exception):
+                text = f"Error executing tool: {result}"
+                print(text)
+            else:
+                text = _extract_text(result, truncate=call["name"] not in UNTRUNCATED_TOOLS)
             self.messages.append({
                 "role": "tool",
-                "content": result.content[0].text,
-                "tool_call_id": tool_call.id,
+                "content": text,
+                "tool_call_id": call["id"],
             })
 
-            # 将结果返回给大模型生成最终响应
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=self.messages,
+        # 将结果返回给大模型生成最终响应
+        # tools 与第一次请求保持一致，请求前缀不变才能命中前缀缓存；
+        # tool_choice="none" 让模型直接给出最终回答
+        stream = self._stream_completion(
+            model=self.model,
+            messages=self.messages,
+            tools=self.tools,
+            tool_choice="none",
+        )
+        print("----------------\n下列为结果：\n")
+        content_parts = []
+        async for text in self._consume_stream(stream, content_parts, {}):
+            yield text
+        self.messages.append({"role": "assistant", "content": "".join(content_parts)})
+        await self._compact_history()
+
+    async def chat_batch(self, prompts: list[str]) -> list[str]:
+        """将多个相互独立的生成请求合并成少量 LLM 调用，按输入顺序返回各自的结果
+
+        每 BATCH_MAX_SIZE 个请求共用一次调用（共享系统prompt的 prefill），各批并发执行；
+        输出被截断的批次会对半拆分重试。批量请求不写入对话历史。
+        """
+        groups = [prompts[i:i + BATCH_MAX_SIZE] for i in range(0, len(prompts), BATCH_MAX_SIZE)]
+        results = await asyncio.gather(*(self._chat_batch_group(group) for group in groups))
+        return [text for group in results for text in group]
+
+    async def _chat_batch_group(self, prompts: list[str]) -> list[str]:
+        parts = [BATCH_INSTRUCTION.format(n=len(prompts))]
+        for i, prompt in enumerate(prompts, 1):
+            parts.append(f"=== REQUEST {i} ===\n{prompt}")
+        # 与 chat() 发送相同的系统prompt和 tools，保证前缀缓存命中
+        extra = {"tools": self.tools, "tool_choice": "none"} if self.tools else {}
+        # 流式接收：长回复在生成过程中持续有数据，不会触发连接池的读超时
+        stream = self._stream_completion(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": "\n\n".join(parts)},
+            ],
+            max_completion_tokens=8072,
+            **extra,
+        )
+        content_parts = []
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                content_parts.append(choice.delta.content)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+
+        # 输出被截断：对半拆分后重试，单个请求仍被截断则报错
+        if finish_reason == "length":
+            if len(prompts) == 1:
+                raise RuntimeError("chat_batch: 单个请求的输出超过 max_completion_tokens，结果被截断")
+            mid = len(prompts) // 2
+            first, second = await asyncio.gather(
+                self._chat_batch_group(prompts[:mid]),
+                self._chat_batch_group(prompts[mid:]),
             )
-            print("----------------\n下列为结果：\n")
-            print(response.choices[0].message.content)
-            return response.choices[0].message.content
-        # TODO 若本地调用不需要调用tool方法，直接返回结果
-        return content.message.content
+            return first + second
+
+        # 按 "=== RESPONSE i ===" 切分，缺失的结果返回空字符串
+        outputs = [""] * len(prompts)
+        pieces = _BATCH_RESPONSE_RE.split("".join(content_parts))
+        for index, body in zip(pieces[1::2], pieces[2::2]):
+            i = int(index) - 1
+            if 0 <= i < len(outputs):
+                outputs[i] = body.strip()
+        return outputs
 
     # async def execute_tool(self, llm_response: str):
     #     """Process the LLM response and execute tools if needed.
@@ -1079,18 +1422,23 @@ end_platform
     #     except json.JSONDecodeError:
     #         return llm_response
 
+    async def cleanup(self):
+        """关闭 MCP 会话及 stdio 连接"""
+        await self.exit_stack.aclose()
+
     async def chat_loop(self):
         """运行交互式聊天循环"""
         print("MCP 客户端启动")
         print("输入 /bye 退出")
 
         while True:
-            prompt = input(">>> ").strip()
+            prompt = (await _ainput(">>> ")).strip()
             if prompt.lower() == '/bye':
                 break
 
-            llm_response = await self.chat(prompt)
-            print(llm_response)
+            async for text in self.chat(prompt):
+                print(text, end="", flush=True)
+            print()
             # result = await self.execute_tool(llm_response)
             #
             # if result != llm_response:
@@ -1112,9 +1460,18 @@ async def main():
 
     client = MCPClient()
 
-    await client.connect_to_server(sys.argv[1])
-    await client.chat_loop()
+    try:
+        await client.connect_to_server(sys.argv[1])
+        await client.chat_loop()
+    finally:
+        await client.cleanup()
+        await _http_client.aclose()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop  # 可选依赖，基于 libuv 的事件循环（不支持 Windows）
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
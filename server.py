@@ -1,6 +1,9 @@
+import asyncio
+import functools
+import os
 from mcp.server.fastmcp import FastMCP
-from pathlib import Path
 from datetime import datetime
+from pathlib import Path
 
 # --- 脚本片段构建器 ---
 class ScriptBuilder:
@@ -12,19 +15,115 @@ class ScriptBuilder:
         self.reset()
 
     def reset(self):
+        # 各分区保存 UTF-8 编码后的片段，写盘时无需再整体编码
         self.sections   = {k: [] for k in self.ORDER}
         self.registered = set()
+        # 被 add 修改过、尚未折叠的分区
+        self._dirty     = set()
 
     def add(self, kind: str, snippet: str, name: str | None = None):
-        # 用 (kind,name) 去重；name 为空时退化为全文去重
-        key = (kind, name or snippet)
+        # 用 (kind,name) 去重；name 为空时退化为全文去重，
+        # 只保存全文的哈希值，registered 不再持有整段 snippet
+        key = (kind, name) if name else (kind, hash(snippet))
         if key in self.registered:
             return
         self.registered.add(key)
-        self.sections[kind].append(snippet.rstrip() + "\n")
+        self.sections[kind].append((snippet.rstrip() + "\n").encode("utf-8"))
+        self._dirty.add(kind)
+
+    def render(self) -> bytes:
+        """渲染完整脚本（UTF-8 字节）"""
+        # 被修改过的分区折叠成单个 bytes：既是下次 render 的缓存，
+        # 又不再额外持有各个 snippet，每个分区在内存中只保留一份
+        for k in self._dirty:
+            self.sections[k] = [b"\n".join(self.sections[k])]
+        self._dirty.clear()
+        return b"\n".join(self.sections[k][0] for k in self.ORDER if self.sections[k])
+
+    def checkpoint(self):
+        """记录刚渲染完的内容，供 discard 之后只清掉这一部分"""
+        return {k: v[0] for k, v in self.sections.items() if v}, set(self.registered)
+
+    def discard(self, checkpoint):
+        """清掉 checkpoint 时已有的片段，保留其后新增的片段"""
+        blobs, keys = checkpoint
+        for k, blob in blobs.items():
+            cur = self.sections[k]
+            if cur and cur[0] is blob:
+                del cur[0]
+            elif cur and cur[0].startswith(blob + b"\n"):
+                # 其间又被 render 折叠过：去掉开头已渲染的部分
+                cur[0] = cur[0][len(blob) + 1:]
+        self.registered -= keys
+
+# finalize_script 只允许写到启动目录之内
+_OUTPUT_DIR = Path.cwd().resolve()
+
+def _resolve_output_path(path: str) -> Path:
+    """把模型给出的相对路径解析到 _OUTPUT_DIR 下；绝对路径、".." 或越界的符号链接一律拒绝"""
+    p = Path(path)
+    if p.is_absolute() or p.anchor or ".." in p.parts:
+        raise ValueError(f"path 必须是不含 '..' 的相对路径: {path!r}")
+    target = (_OUTPUT_DIR / p).resolve()
+    if not target.is_relative_to(_OUTPUT_DIR):
+        raise ValueError(f"path 超出输出目录 {_OUTPUT_DIR}: {path!r}")
+    return target
+
+def _write_bytes(path: str | Path, data: bytes) -> None:
+    """一次 open + write 写出整个文件（覆盖已有内容）"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+@functools.lru_cache(maxsize=1024)
+def _component_block(kind: str, type_name: str) -> str:
+    """platform_type 中的 sensor/weapon/processor 子块，实例名为类型名的小写形式"""
+    return f"   {kind} {type_name.lower()} {type_name}\n   end_{kind}"
+
+# --- 脚本片段模板（模块级，各工具调用时直接填充） ---
+_RADAR_SIGNATURE_TMPL = """radar_signature {name}
+   constant {constant_dbsm} m^2
+end_radar_signature
+"""
+
+_RADAR_SENSOR_TMPL = """sensor {name} WSF_RADAR_SENSOR
+   one_m2_detect_range {one_m2_range_nm} nm
+   maximum_range {max_range_nm} nm
+end_sensor
+"""
+
+_SCRIPT_PROCESSOR_TMPL = """processor {name} WSF_SCRIPT_PROCESSOR
+{body}
+end_processor
+"""
+
+_PLATFORM_TYPE_TMPL = """platform_type {name} WSF_PLATFORM
+   mover {mover}
+   end_mover
+end_platform_type
+"""
 
-    def render(self) -> str:
-        return "\n".join(line for k in self.ORDER for line in self.sections[k])
+_WEAPON_EFFECTS_TMPL = """weapon_effects {name} WSF_GRADUATED_LETHALITY
+   radius_and_pk {max_radius_m} m {pk}
+end_weapon_effects
+"""
+
+_WEAPON_TMPL = """weapon {name} WSF_EXPLICIT_WEAPON
+   launched_platform_type {launched_platform_type}
+   weapon_effects {effects}
+   quantity {quantity}
+end_weapon
+"""
+
+_PLATFORM_TMPL = """platform {name} {platform_type}
+   position {lat} {lon} altitude {altitude}
+   side {side}
+end_platform
+"""
 
 #把它当作 system_prompt 传给 FastMCP
 # 创建 MCP 服务实例
@@ -38,10 +137,7 @@ def define_radar_signature(name: str, constant_dbsm: float) -> str:
     """
     定义雷达截面积 (RCS) 常量
     """
-    snippet = f"""radar_signature {name}
-   constant {constant_dbsm} m^2
-end_radar_signature
-"""
+    snippet = _RADAR_SIGNATURE_TMPL.format_map({"name": name, "constant_dbsm": constant_dbsm})
     builder.add("physical", snippet)
     return snippet
 
@@ -51,11 +147,9 @@ def create_radar_sensor(name: str, one_m2_range_nm: float, max_range_nm: float)
     """
     创建雷达传感器模块
     """
-    snippet = f"""sensor {name} WSF_RADAR_SENSOR
-   one_m2_detect_range {one_m2_range_nm} nm
-   maximum_range {max_range_nm} nm
-end_sensor
-"""
+    snippet = _RADAR_SENSOR_TMPL.format_map(
+        {"name": name, "one_m2_range_nm": one_m2_range_nm, "max_range_nm": max_range_nm}
+    )
     builder.add("sensor", snippet)
     return snippet
 
@@ -65,10 +159,7 @@ def create_script_processor(name: str, body: str) -> str:
     """
     创建脚本处理器，body 包含 on_update 等逻辑
     """
-    snippet = f"""processor {name} WSF_SCRIPT_PROCESSOR
-{body}
-end_processor
-"""
+    snippet = _SCRIPT_PROCESSOR_TMPL.format_map({"name": name, "body": body})
     builder.add("processor", snippet)
     return snippet
 
@@ -82,17 +173,16 @@ def create_platform_type(name: str,
     """
     定义通用平台类型，包含 mover、sensors、weapons、processors
     """
-    sensors = sensors or []
-    weapons = weapons or []
-    processors = processors or []
-    lines = [f"platform_type {name} WSF_PLATFORM"]
-    lines.append(f"   mover {mover}\n   end_mover")
-    for s in sensors:
-        lines.append(f"   sensor {s.lower()} {s}\n   end_sensor")
-    for w in weapons:
-        lines.append(f"   weapon {w.lower()} {w}\n   end_weapon")
-    for p in processors:
-        lines.append(f"   processor {p.lower()} {p}\n   end_processor")
+    if not (sensors or weapons or processors):
+        # 最常见的情况：只有 mover，直接套用模板
+        snippet = _PLATFORM_TYPE_TMPL.format_map({"name": name, "mover": mover})
+        builder.add("platform_type", snippet)
+        return snippet
+
+    lines = [f"platform_type {name} WSF_PLATFORM", f"   mover {mover}\n   end_mover"]
+    lines.extend(_component_block("sensor", s) for s in sensors or ())
+    lines.extend(_component_block("weapon", w) for w in weapons or ())
+    lines.extend(_component_block("processor", p) for p in processors or ())
     lines.append("end_platform_type")
     snippet = "\n".join(lines) + "\n"
     builder.add("platform_type", snippet)
@@ -104,10 +194,7 @@ def create_weapon_effects(name: str, max_radius_m: float, pk: float) -> str:
     """
     定义武器毁伤效果
     """
-    snippet = f"""weapon_effects {name} WSF_GRADUATED_LETHALITY
-   radius_and_pk {max_radius_m} m {pk}
-end_weapon_effects
-"""
+    snippet = _WEAPON_EFFECTS_TMPL.format_map({"name": name, "max_radius_m": max_radius_m, "pk": pk})
     builder.add("weapon_effects", snippet)
     return snippet
 
@@ -120,12 +207,12 @@ def create_weapon(name: str,
     """
     定义显式武器，指定发射后平台类型和毁伤效果
     """
-    snippet = f"""weapon {name} WSF_EXPLICIT_WEAPON
-   launched_platform_type {launched_platform_type}
-   weapon_effects {effects}
-   quantity {quantity}
-end_weapon
-"""
+    snippet = _WEAPON_TMPL.format_map({
+        "name": name,
+        "launched_platform_type": launched_platform_type,
+        "effects": effects,
+        "quantity": quantity,
+    })
     builder.add("weapon", snippet)
     return snippet
 
@@ -140,24 +227,35 @@ def create_platform(name: str,
     """
     创建平台实例，设置位置与阵营
     """
-    snippet = f"""platform {name} {platform_type}
-   position {lat} {lon} altitude {altitude}
-   side {side}
-end_platform
-"""
+    snippet = _PLATFORM_TMPL.format_map({
+        "name": name,
+        "platform_type": platform_type,
+        "side": side,
+        "lat": lat,
+        "lon": lon,
+        "altitude": altitude,
+    })
     builder.add("platform", snippet)
     return snippet
 
 # ---------- 终结脚本 ----------
 @mcp.tool()
-def finalize_script(save: bool = True, reset: bool = False) -> str:
-    script = builder.render()
+async def finalize_script(save: bool = True, reset: bool = False, path: str = "out.txt") -> str:
+    """
+    汇总已生成的脚本片段，可保存到 path 并重置构建器
+    path 须为服务启动目录下的相对路径（不能是绝对路径或包含 ".."）
+    """
+    # 先校验路径：非法 path 直接报错，不渲染也不重置
+    target = _resolve_output_path(path) if save else None
+    data = builder.render()
+    rendered = builder.checkpoint() if reset else None
     if save:
-        Path(...).write_text(script, "utf-8")
-    if reset:
-        builder.sections = {k: [] for k in builder.ORDER}
-        builder.registered.clear()
-    return script
+        # 片段在 add 时已编码为 UTF-8，直接写出；磁盘写入放到线程中执行，避免阻塞 MCP 服务的事件循环
+        await asyncio.to_thread(_write_bytes, target, data)
+    # 写盘成功后才重置，且只清掉已渲染的片段：写盘失败时脚本仍在，写盘期间新增的片段保留到下一份脚本
+    if rendered is not None:
+        builder.discard(rendered)
+    return data.decode("utf-8")
 
 @mcp.tool()
 def calculate_bmi(weight_kg: float, height_m: float) -> float: